@@ -1,8 +1,8 @@
 import datetime
+import json
 import os
-
-from dotenv import load_dotenv
-import requests
+from pathlib import Path
+import time
 
 import jobs_common
 
@@ -10,17 +10,44 @@ import jobs_common
 monitored_city_latitude = "33.99755743650663"
 monitored_city_longitude = "-96.72286077920174"
 temperature_threshold = 34
+open_weather_day_summary_url = "https://api.openweathermap.org/data/3.0/onecall/day_summary"
+day_summary_cache_dir = Path.home() / ".cache" / "cabin_temp"
+# Seconds a cached day summary is reused before asking OpenWeather again
+day_summary_cache_ttl = 3 * 60 * 60
 
 
 def get_monitored_temperature(one_week_from_today):
-    global monitored_city_latitude
-    global monitored_city_longitude
+    cached_summary_path = (
+        day_summary_cache_dir
+        / f"{one_week_from_today}_{monitored_city_latitude}_{monitored_city_longitude}.json"
+    )
+    if (
+        cached_summary_path.exists()
+        and time.time() - cached_summary_path.stat().st_mtime < day_summary_cache_ttl
+    ):
+        try:
+            return json.loads(cached_summary_path.read_text())["temperature"]["min"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # A damaged cache is just a miss, the summary gets fetched again and replaces it
+            print(f"Ignoring unreadable cached day summary: {e}")
 
-    url = f"https://api.openweathermap.org/data/3.0/onecall/day_summary?lat={monitored_city_latitude}&lon={monitored_city_longitude}&date={one_week_from_today}&units=imperial&appid={os.getenv('OPEN_WEATHER_API_TOKEN')}"
-    response = requests.get(url)
+    params = {
+        "lat": monitored_city_latitude,
+        "lon": monitored_city_longitude,
+        "date": one_week_from_today,
+        "units": "imperial",
+        "appid": os.getenv("OPEN_WEATHER_API_TOKEN"),
+    }
+    response = jobs_common.session.get(
+        open_weather_day_summary_url, params=params, timeout=(3, 10)
+    )
     if response.status_code > 299:
-        print(response.text)
-    return response.json()["temperature"]["min"]
+        print(jobs_common.error_body_preview(response))
+    day_summary = response.json()
+    if response.ok:
+        day_summary_cache_dir.mkdir(parents=True, exist_ok=True)
+        jobs_common.write_cache_file(cached_summary_path, json.dumps(day_summary).encode())
+    return day_summary["temperature"]["min"]
 
 
 def send_discord_notification(next_week_min_temp, next_week_date):
@@ -32,10 +59,10 @@ def send_discord_notification(next_week_min_temp, next_week_date):
 def main():
     global temperature_threshold
 
-    load_dotenv()
+    jobs_common.load_dotenv_if_present()
     one_week_from_today = (
-        datetime.datetime.now() + datetime.timedelta(days=7)
-    ).strftime("%Y-%m-%d")
+        datetime.date.today() + datetime.timedelta(days=7)
+    ).isoformat()
     next_week_min_temp = get_monitored_temperature(one_week_from_today)
     if next_week_min_temp <= temperature_threshold:
         send_discord_notification(next_week_min_temp, one_week_from_today)
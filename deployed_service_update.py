@@ -1,22 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import io
+import hashlib
+import json
 import os
+from pathlib import Path
+import re
+import time
 from typing import Any
 
-from dotenv import load_dotenv
 from github import Auth
 from github import ContentFile
 from github import Github
+from github import InputGitTreeElement
 from github import Repository
-from natsort import natsorted
+from natsort import natsort_keygen
+from packaging.version import InvalidVersion
+from packaging.version import Version
 import requests
 import yaml
 
 import jobs_common
 
+# Prefer the libyaml backed C implementations when PyYAML was built with them
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper
+    from yaml import SafeLoader
+
+
+helm_index_cache_dir = Path.home() / ".cache" / "jobs" / "helm-index"
+# Seconds a cached index is trusted without asking the repo if it changed
+helm_index_cache_ttl = 300
+
+natural_version_key = natsort_keygen()
+is_prerelease_version = re.compile(r"dev|alpha|beta|rc", re.IGNORECASE).search
+major_version_pattern = re.compile(r"v?(\d+)")
+skipped_kustomize_folders = frozenset({"overlays"})
+
 
 def main():
-    load_dotenv()
+    jobs_common.load_dotenv_if_present()
     github_PAT = os.getenv("GITHUB_PAT")
 
     # using an access token
@@ -27,11 +52,13 @@ def main():
     gh = Github(auth=auth)
 
     argo_repo = gh.get_repo("neboman11/argocd-definitions")
-    repo_contents = argo_repo.get_contents("/")
+
+    # Pin the whole run to one commit of the default branch, the files are read from it and the
+    # update branch is created from it, which also saves looking the branch up again later
+    default_branch_sha = argo_repo.get_branch(argo_repo.default_branch).commit.sha
 
     print("Finding kustomize files in repo")
-    kustomize_files: list[ContentFile.ContentFile] = []
-    find_kustomize_file(argo_repo, repo_contents, kustomize_files)
+    kustomize_files = find_kustomize_file(argo_repo, default_branch_sha)
 
     print("Checking helm chart versions for update")
     files_needing_updates = kustomize_files_find_helm_charts_with_updates(
@@ -41,34 +68,41 @@ def main():
     if len(files_needing_updates) > 0:
         date_string = datetime.now().strftime("%Y-%m-%d")
         new_branch_name = f"service_update/{date_string}"
-        target_branch = create_branch_for_chart_updates(argo_repo, new_branch_name)
-
-        charts_to_directly_update = list(
-            filter(chart_updates_with_minor_or_patch_filter, files_needing_updates)
-        )
-
-        if len(charts_to_directly_update) > 0:
-            non_major_pull_request = create_pull_request_for_updates(
-                argo_repo, new_branch_name, target_branch.ref, charts_to_directly_update
-            )
-
-            non_major_pull_request.merge()
-
-            jobs_common.send_discord_notification("Updated versions for " + ", ".join([chart["release_name"] for chart in charts_to_directly_update]))
-
-        charts_with_major_version = list(
-            filter(
-                lambda x: not chart_updates_with_minor_or_patch_filter(x),
-                files_needing_updates,
-            )
+        target_branch = create_branch_for_chart_updates(
+            argo_repo, new_branch_name, default_branch_sha
         )
 
-        if len(charts_with_major_version) > 0:
-            non_major_pull_request = create_pull_request_for_updates(
-                argo_repo, new_branch_name, target_branch.ref, charts_with_major_version
-            )
-
-            jobs_common.send_discord_notification("Created PR for major version bumps on " + ", ".join([chart["release_name"] for chart in charts_with_major_version]))
+        charts_to_directly_update: list[dict[str, Any]] = []
+        charts_with_major_version: list[dict[str, Any]] = []
+        for chart_update in files_needing_updates:
+            if chart_updates_with_minor_or_patch_filter(chart_update):
+                charts_to_directly_update.append(chart_update)
+            else:
+                charts_with_major_version.append(chart_update)
+
+        # Collect everything that happened and report it in a single Discord message
+        notifications: list[str] = []
+
+        # Report from finally so an auto-merge is still announced if the major version PR fails
+        try:
+            if len(charts_to_directly_update) > 0:
+                non_major_pull_request = create_pull_request_for_updates(
+                    argo_repo, new_branch_name, target_branch.ref, charts_to_directly_update
+                )
+
+                non_major_pull_request.merge()
+
+                notifications.append("Updated versions for " + ", ".join([chart["release_name"] for chart in charts_to_directly_update]))
+
+            if len(charts_with_major_version) > 0:
+                non_major_pull_request = create_pull_request_for_updates(
+                    argo_repo, new_branch_name, target_branch.ref, charts_with_major_version
+                )
+
+                notifications.append("Created PR for major version bumps on " + ", ".join([chart["release_name"] for chart in charts_with_major_version]))
+        finally:
+            if len(notifications) > 0:
+                jobs_common.send_discord_notification("\n".join(notifications))
     else:
         print("Found no charts to update")
 
@@ -87,18 +121,20 @@ def create_pull_request_for_updates(
 
 
 def chart_updates_with_minor_or_patch_filter(helm_chart_update):
-    split_original_version = helm_chart_update["original_version"].split(".")
-    split_new_version = helm_chart_update["new_version"].split(".")
-    if split_original_version[0] != split_new_version[0]:
+    original_major = major_version_pattern.match(helm_chart_update["original_version"])
+    new_major = major_version_pattern.match(helm_chart_update["new_version"])
+    # Treat versions we can't read a major version from as major bumps so they get reviewed
+    if original_major is None or new_major is None:
         return False
-    return True
+    return original_major.group(1) == new_major.group(1)
 
 
-def create_branch_for_chart_updates(argo_repo: Repository.Repository, new_branch_name):
+def create_branch_for_chart_updates(
+    argo_repo: Repository.Repository, new_branch_name, default_branch_sha: str
+):
     print("Creating branch to store changes in")
-    main_branch = argo_repo.get_git_ref(f"heads/{argo_repo.default_branch}")
     new_branch = argo_repo.create_git_ref(
-        f"refs/heads/{new_branch_name}", main_branch.object.sha
+        f"refs/heads/{new_branch_name}", default_branch_sha
     )
 
     return new_branch
@@ -110,103 +146,371 @@ def commit_updates_to_branch(
     files_needing_updates: list[dict[str, Any]],
 ):
     print("Committing changes to update helm charts")
+    # Build one tree holding every updated file so all the bumps land in a single commit
+    branch_ref = argo_repo.get_git_ref(target_branch_ref.removeprefix("refs/"))
+    parent_commit = argo_repo.get_git_commit(branch_ref.object.sha)
+    tree_elements: list[InputGitTreeElement] = []
+    commit_message_lines: list[str] = []
     for file in files_needing_updates:
-        file_content_stream = io.StringIO()
-        yaml.dump(file["kustomize_file"], file_content_stream)
-        file_content_stream.seek(0)
-        argo_repo.update_file(
-            file["path"],
-            f"Bump {file['release_name']} version to {file['new_version']}",
-            file_content_stream.getvalue(),
-            file["sha"],
-            target_branch_ref,
+        file_content = yaml.dump(
+            file["kustomize_file"], Dumper=SafeDumper, sort_keys=False
+        )
+        tree_elements.append(
+            InputGitTreeElement(file["path"], "100644", "blob", content=file_content)
+        )
+        commit_message_lines.append(
+            f"Bump {file['release_name']} version to {file['new_version']}"
         )
 
+    new_tree = argo_repo.create_git_tree(tree_elements, base_tree=parent_commit.tree)
+    new_commit = argo_repo.create_git_commit(
+        "Bump helm chart versions\n\n" + "\n".join(commit_message_lines),
+        new_tree,
+        [parent_commit],
+    )
+    branch_ref.edit(new_commit.sha)
+
 
 def kustomize_files_find_helm_charts_with_updates(
     kustomize_files: list[ContentFile.ContentFile],
 ):
-    files_needing_updates: list[dict[str, Any]] = []
+    helm_kustomize_files: list[tuple[ContentFile.ContentFile, dict]] = []
     for kustomize_file in kustomize_files:
-        file_stream = io.BytesIO(kustomize_file.decoded_content)
-        parsed_file = yaml.safe_load(file_stream)
+        # decoded_content base64 decodes on every access so only read it once
+        raw_content = kustomize_file.decoded_content
+        # Skip parsing files that can't possibly contain a helm chart
+        if b"helmCharts" not in raw_content:
+            continue
+        parsed_file = yaml.load(raw_content, Loader=SafeLoader)
         # Check that the file contains a helm chart
         if "helmCharts" in parsed_file:
-            updated_file = check_for_helm_chart_update(parsed_file)
-            if updated_file != None:
-                updated_file["path"] = kustomize_file.path
-                updated_file["sha"] = kustomize_file.sha
-                files_needing_updates.append(updated_file)
+            if parsed_file["helmCharts"][0]["namespace"] == "databases":
+                continue
+            helm_kustomize_files.append((kustomize_file, parsed_file))
+
+    # Many charts share a repo, so only pull each distinct index once and do it concurrently
+    chart_names_by_repo: dict[str, set[str]] = {}
+    for _, parsed_file in helm_kustomize_files:
+        deployed_chart = parsed_file["helmCharts"][0]
+        chart_names_by_repo.setdefault(get_chart_repo(deployed_chart), set()).add(
+            deployed_chart["name"]
+        )
+    chart_repos = list(chart_names_by_repo)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        repository_indexes = dict(
+            zip(
+                chart_repos,
+                executor.map(
+                    fetch_index,
+                    chart_repos,
+                    [chart_names_by_repo[chart_repo] for chart_repo in chart_repos],
+                ),
+            )
+        )
+
+    files_needing_updates: list[dict[str, Any]] = []
+    for kustomize_file, parsed_file in helm_kustomize_files:
+        repository_index = repository_indexes[get_chart_repo(parsed_file["helmCharts"][0])]
+        if repository_index is None:
+            continue
+        updated_file = check_for_helm_chart_update(parsed_file, repository_index)
+        if updated_file != None:
+            updated_file["path"] = kustomize_file.path
+            files_needing_updates.append(updated_file)
     return files_needing_updates
 
 
-def check_for_helm_chart_update(kustomize_file: dict):
-    deployed_chart = kustomize_file["helmCharts"][0]
-    if deployed_chart["namespace"] == "databases":
-        return
-
+def get_chart_repo(deployed_chart: dict):
     chart_repo = deployed_chart["repo"]
     if not chart_repo.endswith("/"):
         chart_repo += "/"
-
-    # Pull the index file containing all the available charts at the repo
-    response = requests.get(f"{chart_repo}index.yaml")
+    return chart_repo
+
+
+def fetch_index(chart_repo: str, chart_names: set[str]):
+    repo_hash = hashlib.sha1(chart_repo.encode()).hexdigest()
+    cached_index_path = helm_index_cache_dir / f"{repo_hash}.yaml"
+    cached_meta_path = helm_index_cache_dir / f"{repo_hash}.json"
+
+    cached_meta = None
+    if cached_index_path.exists() and cached_meta_path.exists():
+        try:
+            cached_meta = json.loads(cached_meta_path.read_text())
+            if not isinstance(cached_meta, dict):
+                raise ValueError("cache metadata is not an object")
+            # Skip the network entirely for back to back runs
+            if time.time() - cached_index_path.stat().st_mtime < helm_index_cache_ttl:
+                return load_cached_index(cached_index_path, cached_meta_path, cached_meta, chart_names)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            # A damaged cache is just a miss, the index gets downloaded again and replaces it
+            print(f"Ignoring unreadable cached chart index for {chart_repo}: {e}")
+            cached_meta = None
+
+    headers = {}
+    if cached_meta is not None:
+        if cached_meta.get("etag"):
+            headers["If-None-Match"] = cached_meta["etag"]
+        if cached_meta.get("last_modified"):
+            headers["If-Modified-Since"] = cached_meta["last_modified"]
+
+    response = request_index(chart_repo, headers)
+    if response is None:
+        return
+    if response.status_code == 304:
+        try:
+            cached_index_path.touch()
+            return load_cached_index(cached_index_path, cached_meta_path, cached_meta, chart_names)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            print(f"Ignoring unreadable cached chart index for {chart_repo}: {e}")
+            response = request_index(chart_repo, {})
+            if response is None:
+                return
     if not response.ok:
-        print(response.content)
+        print(f"Failure fetching chart index from {chart_repo}: {response.status_code} - {jobs_common.error_body_preview(response)}")
+        return
+
+    try:
+        repository_index = load_index_entries(response.content, chart_names)
+    except (yaml.YAMLError, TypeError, KeyError, AttributeError) as e:
+        # e.g. an empty body or a proxy's HTML page served with a 200
+        print(f"Failure reading chart index from {chart_repo}: {e} - {jobs_common.error_body_preview(response)}")
         return
-    repository_index = yaml.safe_load(io.BytesIO(response.content))
-
-    # Select the available chart versions from the repo
-    remote_versions = [
-        chart["version"]
-        for chart in repository_index["entries"][deployed_chart["name"]]
-    ]
-
-    # Filter out prerelease versions
-    remote_versions = list(
-        filter(
-            lambda x: "dev" not in x and "alpha" not in x and "beta" not in x,
-            remote_versions,
+    helm_index_cache_dir.mkdir(parents=True, exist_ok=True)
+    jobs_common.write_cache_file(cached_index_path, response.content)
+    write_index_meta(
+        cached_meta_path,
+        {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "chart_versions": {},
+        },
+        repository_index,
+    )
+    return repository_index
+
+
+def request_index(chart_repo: str, headers: dict[str, str]):
+    # Pull the index file containing all the available charts at the repo
+    try:
+        # Helm indexes can be several MB so allow a longer read than other calls
+        return jobs_common.session.get(
+            f"{chart_repo}index.yaml", headers=headers, timeout=(3, 30)
         )
+    except requests.exceptions.Timeout as e:
+        print(f"Timed out fetching chart index from {chart_repo}: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"Failure fetching chart index from {chart_repo}: {e}")
+
+
+def load_cached_index(
+    cached_index_path: Path, cached_meta_path: Path, cached_meta: dict, chart_names: set[str]
+):
+    # The cached index is unchanged since the versions in the meta file were recorded from it, so
+    # when every requested chart was seen before there is no need to parse the index at all
+    chart_versions = cached_meta.get("chart_versions", {})
+    if chart_names.issubset(chart_versions):
+        return {
+            "entries": {
+                chart_name: [{"version": version} for version in chart_versions[chart_name]]
+                for chart_name in chart_names
+            }
+        }
+
+    repository_index = load_index_entries(cached_index_path.read_bytes(), chart_names)
+    write_index_meta(cached_meta_path, cached_meta, repository_index)
+    return repository_index
+
+
+def write_index_meta(cached_meta_path: Path, cached_meta: dict, repository_index: dict):
+    cached_meta.setdefault("chart_versions", {}).update(
+        {
+            chart_name: [chart["version"] for chart in chart_entries]
+            for chart_name, chart_entries in repository_index["entries"].items()
+        }
+    )
+    jobs_common.write_cache_file(cached_meta_path, json.dumps(cached_meta).encode())
+
+
+def load_index_entries(index_content: bytes, chart_names: set[str]):
+    # Repo indexes can list thousands of charts with a lot of metadata per version, so walk the
+    # parser's event stream instead of building the document. Only the version numbers of the
+    # charts that are actually deployed get constructed, and parsing stops once they're all read.
+    loader = SafeLoader(index_content)
+    try:
+        entries = {}
+        remaining_chart_names = set(chart_names)
+        # Stream start, document start, and the start of the index mapping
+        for _ in range(3):
+            loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key_event = loader.get_event()
+            if not is_plain_key_event(key_event):
+                return load_index_entries_from_document(index_content, chart_names)
+            if key_event.value != "entries":
+                skip_event_node(loader)
+                continue
+
+            loader.get_event()
+            while remaining_chart_names and not loader.check_event(yaml.MappingEndEvent):
+                chart_event = loader.get_event()
+                if not is_plain_key_event(chart_event):
+                    return load_index_entries_from_document(index_content, chart_names)
+                if chart_event.value not in remaining_chart_names:
+                    skip_event_node(loader)
+                    continue
+                if not loader.check_event(yaml.SequenceStartEvent):
+                    return load_index_entries_from_document(index_content, chart_names)
+                chart_versions = load_chart_versions(loader)
+                if chart_versions is None:
+                    return load_index_entries_from_document(index_content, chart_names)
+                entries[chart_event.value] = chart_versions
+                remaining_chart_names.discard(chart_event.value)
+            break
+        return {"entries": entries}
+    finally:
+        loader.dispose()
+
+
+def load_chart_versions(loader: SafeLoader):
+    # Returns None when the chart uses aliases or merge keys, those can pull in values from
+    # anywhere earlier in the document so the caller has to load it properly instead
+    chart_versions = []
+    loader.get_event()
+    while not loader.check_event(yaml.SequenceEndEvent):
+        if loader.check_event(yaml.AliasEvent):
+            return None
+        if not loader.check_event(yaml.MappingStartEvent):
+            skip_event_node(loader)
+            continue
+
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            field_event = loader.get_event()
+            if not is_plain_key_event(field_event):
+                return None
+            if field_event.value != "version":
+                skip_event_node(loader)
+                continue
+            if loader.check_event(yaml.AliasEvent):
+                return None
+            if not loader.check_event(yaml.ScalarEvent):
+                skip_event_node(loader)
+                continue
+
+            version_event = loader.get_event()
+            # Resolve the scalar the same way a full load would so e.g. an unquoted 1.0 stays a float
+            version_tag = loader.resolve(
+                yaml.ScalarNode, version_event.value, version_event.implicit
+            )
+            chart_versions.append(
+                {
+                    "version": loader.construct_object(
+                        yaml.ScalarNode(
+                            version_tag, version_event.value, style=version_event.style
+                        )
+                    )
+                }
+            )
+        loader.get_event()
+    loader.get_event()
+    return chart_versions
+
+
+def is_plain_key_event(event: yaml.Event):
+    # Anything other than an ordinary scalar key (aliases, merge keys, complex keys) needs the
+    # full loader to be interpreted correctly
+    return isinstance(event, yaml.ScalarEvent) and not (
+        event.value == "<<" and event.implicit[0]
     )
 
-    # Sort the versions descending so the highest version is at the beginning
-    remote_versions = list(natsorted(remote_versions, reverse=True))
 
-    if remote_versions[0] != deployed_chart["version"]:
+def load_index_entries_from_document(index_content: bytes, chart_names: set[str]):
+    repository_index = yaml.load(index_content, Loader=SafeLoader)
+    return {
+        "entries": {
+            chart_name: [
+                {"version": chart["version"]}
+                for chart in chart_versions
+                if isinstance(chart, dict) and "version" in chart
+            ]
+            for chart_name, chart_versions in repository_index["entries"].items()
+            if chart_name in chart_names
+        }
+    }
+
+
+def skip_event_node(loader: SafeLoader):
+    # Consume the events of the next node, including everything nested inside it
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def chart_version_key(version: str):
+    # Chart versions are SemVer so parse them directly, only falling back to natural sorting
+    # for anything that isn't. Parsed versions always rank above ones that couldn't be parsed.
+    try:
+        return (1, Version(version))
+    except InvalidVersion:
+        return (0, natural_version_key(version))
+
+
+def check_for_helm_chart_update(kustomize_file: dict, repository_index: dict):
+    deployed_chart = kustomize_file["helmCharts"][0]
+
+    # Find the highest non prerelease version in a single pass over the repo's versions
+    latest_version = max(
+        (
+            chart["version"]
+            for chart in repository_index["entries"][deployed_chart["name"]]
+            if not is_prerelease_version(chart["version"])
+        ),
+        key=chart_version_key,
+        default=None,
+    )
+
+    if latest_version is not None and latest_version != deployed_chart["version"]:
         # Return an object containing the file object with the updated version, the old, version, and the new version
         original_version = deployed_chart["version"]
-        kustomize_file["helmCharts"][0]["version"] = remote_versions[0]
+        kustomize_file["helmCharts"][0]["version"] = latest_version
         return {
             "kustomize_file": kustomize_file,
             "original_version": original_version,
-            "new_version": remote_versions[0],
+            "new_version": latest_version,
             "release_name": deployed_chart["releaseName"],
         }
 
 
-def find_kustomize_file(
-    argo_repo: Repository.Repository,
-    repo_files: list[ContentFile.ContentFile],
-    kustomize_file_list: list[ContentFile.ContentFile],
-):
-    for file in repo_files:
-        if file.type == "file" and file.name == "kustomization.yaml":
-            kustomize_file_list.append(file)
-        if file.type == "dir" and file.name != "overlays":
-            folder_contents = argo_repo.get_contents(f"/{file.path}")
-            find_kustomize_file(argo_repo, folder_contents, kustomize_file_list)
-
-
-def send_discord_notification(message):
-    url = f"{os.getenv('PONYBOY_BASE_URL')}/send_discord_message"
-    request = {
-        "user_id": int(os.getenv("NOTIFY_DISCORD_USER")),
-        "message": message,
-    }
-    response = requests.post(url, json=request)
-    if response.status_code > 299:
-        print(response.text)
+def find_kustomize_file(argo_repo: Repository.Repository, default_branch_sha: str):
+    # List every file in the repo with a single request rather than walking it directory by directory
+    repo_tree = argo_repo.get_git_tree(default_branch_sha, recursive=True)
+    if repo_tree.raw_data.get("truncated"):
+        # GitHub caps recursive tree listings, anything past the cap won't be checked this run.
+        # PyGithub doesn't expose the flag so read it from the raw response
+        print("Repo tree listing was truncated by GitHub, some kustomize files may be missed")
+    kustomize_file_paths = []
+    for entry in repo_tree.tree:
+        # Cheap suffix check first so most of the repo's files are never split into path segments
+        if entry.type != "blob" or not entry.path.endswith("kustomization.yaml"):
+            continue
+        *folders, file_name = entry.path.split("/")
+        if file_name == "kustomization.yaml" and skipped_kustomize_folders.isdisjoint(folders):
+            kustomize_file_paths.append(entry.path)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        kustomize_files: list[ContentFile.ContentFile] = list(
+            executor.map(
+                lambda path: argo_repo.get_contents(path, ref=default_branch_sha),
+                kustomize_file_paths,
+            )
+        )
+    return kustomize_files
 
 
 if __name__ == "__main__":
@@ -1,16 +1,106 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import os
+from pathlib import Path
+import sys
+import tempfile
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Shared across all jobs so repeated requests to the same host reuse a pooled keep-alive connection
+session = requests.Session()
+session.headers.update({"Connection": "keep-alive"})
+# Sized so every worker of a concurrent fan-out (e.g. Helm index fetches) can keep its own
+# connection to a host, and so the pools for each distinct chart repo host stay cached
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=2,
+        status_forcelist=[429, 500, 502, 503, 504, 522],
+        respect_retry_after_header=True,
+        allowed_methods=["GET", "POST"],
+    ),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+
+def error_body_preview(response: requests.Response):
+    # Error responses can be whole HTML pages from a proxy, only the start is useful for logging and
+    # it avoids decoding (and charset detecting) the entire body
+    return response.content[:256].decode("utf-8", "replace")
+
+
+def write_cache_file(cache_path: Path, content: bytes):
+    # Write to a temporary file and swap it in so an interrupted run never leaves a partial file
+    with tempfile.NamedTemporaryFile(dir=cache_path.parent, delete=False) as temp_file:
+        temp_file.write(content)
+    os.replace(temp_file.name, cache_path)
+
+
+def load_dotenv_if_present():
+    # Search the same places python-dotenv's load_dotenv() would, the running script's directory
+    # and then its parents, but only pay for importing python-dotenv once a .env file is found
+    main_file = getattr(sys.modules["__main__"], "__file__", None)
+    search_dir = Path(main_file).resolve().parent if main_file else Path.cwd()
+    for directory in (search_dir, *search_dir.parents):
+        env_file = directory / ".env"
+        if env_file.is_file():
+            from dotenv import load_dotenv
+
+            load_dotenv(env_file)
+            return
+
+
+discord_message_url = None
+discord_message_base_request = None
+discord_settings_lock = threading.Lock()
+
+
+def init_discord_notification():
+    # Resolved on first use rather than import so a .env loaded by the job's main is picked up
+    global discord_message_url
+    global discord_message_base_request
+
+    # Notifications post from several threads, so only one resolves the settings and both are
+    # published together once they are known to be valid
+    with discord_settings_lock:
+        if discord_message_base_request is not None:
+            return
+        notify_user = os.getenv("NOTIFY_DISCORD_USER")
+        if notify_user is None:
+            raise ValueError("NOTIFY_DISCORD_USER is not set")
+        message_url = f"{os.getenv('PONYBOY_BASE_URL')}/send_discord_message"
+        base_request = {"user_id": int(notify_user)}
+        discord_message_url = message_url
+        discord_message_base_request = base_request
+
+
+# Notifications are posted in the background so jobs don't wait on the relay, any still in flight
+# are finished before the process exits
+notification_executor = ThreadPoolExecutor(max_workers=2)
+atexit.register(notification_executor.shutdown, wait=True)
 
 
 def send_discord_notification(message: str):
+    notification_executor.submit(post_discord_notification, message)
+
+
+def post_discord_notification(message: str):
     try:
-        url = f"{os.getenv("PONYBOY_BASE_URL")}/send_discord_message"
-        request = {
-            "user_id": int(os.getenv("NOTIFY_DISCORD_USER")),
-            "message": message,
-        }
-        response = requests.post(url, json=request)
+        if discord_message_base_request is None:
+            init_discord_notification()
+        request = {**discord_message_base_request, "message": message}
+        response = session.post(discord_message_url, json=request, timeout=(3, 10))
         if not response.ok:
-            print(f"Failure sending Discord message: {response.status_code} - {response.text}")
+            print(f"Failure sending Discord message: {response.status_code} - {error_body_preview(response)}")
+    except requests.exceptions.Timeout as e:
+        print(f"Timed out sending Discord message: {e}")
     except Exception as e:
         print(f"Failure sending Discord message: {e}")